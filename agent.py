@@ -9,238 +9,514 @@ load_dotenv()
 import os
 import re
 import json
+import logging
+import threading
+import time
+import orjson
 import requests
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from requests.adapters import HTTPAdapter
 from datetime import date, datetime
+from cache import LRUCache, prompt_key
 from tools import (
-    get_agent_context, calculate_priority, load_memory,
+    get_agent_context, calculate_priority, memory_session,
     log_study_hours, update_mood, add_goal, add_task,
     get_all_goals, mark_goal_complete
 )
 
+log = logging.getLogger(__name__)
+
 
 # ---------------------------------------------------------------------------
 # LLM call — Groq API
 # ---------------------------------------------------------------------------
 
-def call_llm(prompt: str) -> str:
-    api_key = os.environ.get("GROQ_API_KEY", "").strip()
+GROQ_URL = "https://api.groq.com/openai/v1/chat/completions"
+
+# Groq model options in order of preference
+GROQ_MODELS = ["llama-3.3-70b-versatile", "llama-3.1-8b-instant", "mixtral-8x7b-32768"]
+
+# One pooled session for every call, so keep-alive reuses the TLS connection
+# across chat turns and model fallbacks instead of handshaking each time.
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=0))
+_SESSION.headers.update({"Content-Type": "application/json"})
+
+# Caps in-flight Groq requests across all request threads, so concurrent
+# chats overlap without bursting past the account's rate limit. This is per
+# process (as are the breaker and response cache below): under gunicorn the
+# account-wide cap is split across workers via gunicorn_conf.py.
+MAX_CONCURRENT_LLM = int(os.environ.get("MAX_CONCURRENT_LLM", "8"))
+_LLM_SLOTS = threading.BoundedSemaphore(MAX_CONCURRENT_LLM)
+
+# Hedged fallback: if the preferred model has not answered within its hedge
+# delay, the next model is started alongside it and the first good reply wins.
+# Replies are not streamed, so the delay has to cover generating the whole
+# answer: a fixed allowance plus max_tokens at a conservative throughput. A
+# healthy reply therefore lands before the hedge fires and only a stalled
+# model costs a second request.
+HEDGE_BASE_DELAY = 1.5
+HEDGE_TOKENS_PER_SEC = 200
+_LLM_POOL = ThreadPoolExecutor(max_workers=2 * MAX_CONCURRENT_LLM, thread_name_prefix="llm")
+
+# Generation settings per intent. Short confirmations get a small token
+# budget; the quiz and weekly plan run at temperature 0 so a repeat prompt can
+# be served from the response cache.
+_DEFAULT_PARAMS = {"max_tokens": 400, "temperature": 0.3}
+_INTENT_PARAMS = {
+    "quiz":        {"max_tokens": 900, "temperature": 0},
+    "plan_week":   {"max_tokens": 700, "temperature": 0},
+    "study_plan":  {"max_tokens": 700, "temperature": 0.3},
+    "log_hours":   {"max_tokens": 200, "temperature": 0.3},
+    "update_mood": {"max_tokens": 200, "temperature": 0.3},
+    "add_goal":    {"max_tokens": 200, "temperature": 0.3},
+    "add_task":    {"max_tokens": 200, "temperature": 0.3},
+    "mark_task":   {"max_tokens": 200, "temperature": 0.3},
+}
+
+# Exact-match response cache. Only deterministic (temperature 0) calls are
+# stored — sampling at higher temperatures is meant to vary between calls.
+_RESPONSE_CACHE = LRUCache(maxsize=256, ttl=3600)
+
+# Per-model circuit breaker. After CB_FAIL_THRESHOLD consecutive 5xx/timeout
+# failures a model is skipped for CB_COOLDOWN seconds; after that a single
+# call is let through as a probe, and a success closes the breaker again.
+CB_FAIL_THRESHOLD = 3
+CB_COOLDOWN = 30.0
+_CB = {m: {"fails": 0, "opened_at": 0.0} for m in GROQ_MODELS}
+_CB_LOCK = threading.Lock()
+
+
+def _cb_allows(model: str) -> bool:
+    with _CB_LOCK:
+        state = _CB[model]
+        if state["fails"] < CB_FAIL_THRESHOLD:
+            return True
+        now = time.monotonic()
+        if now - state["opened_at"] >= CB_COOLDOWN:
+            state["opened_at"] = now   # half-open: this caller is the probe
+            return True
+        return False
+
+
+def _cb_failure(model: str) -> None:
+    with _CB_LOCK:
+        _CB[model]["fails"] += 1
+        _CB[model]["opened_at"] = time.monotonic()
+
+
+def _cb_success(model: str) -> None:
+    with _CB_LOCK:
+        _CB[model]["fails"] = 0
+
+
+def _set_auth(api_key: str) -> None:
+    auth = f"Bearer {api_key}"
+    if _SESSION.headers.get("Authorization") != auth:
+        _SESSION.headers["Authorization"] = auth
+
+
+def _try_model(model: str, prompt: str, params: dict) -> tuple[str, str | None]:
+    """
+    One attempt against one model. Returns (outcome, text):
+      "ok"      — text is the completion
+      "final"   — text is a user-facing error; stop trying models
+      "next"    — this model failed; fall through to the next one
+      "timeout" — as "next", but remembered for the final error message
+    """
+    try:
+        log.debug("Trying model: %s", model)
+
+        # Pre-serialised with orjson; Content-Type/Authorization are already
+        # set on the session.
+        body = orjson.dumps({
+            "model": model,
+            "messages": [{"role": "user", "content": prompt}],
+            **params,
+        })
+        resp = _SESSION.post(GROQ_URL, data=body, timeout=(5, 30))
+
+        log.debug("Status: %s", resp.status_code)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Body: %s", resp.text[:400])
+
+        if resp.status_code >= 500:
+            _cb_failure(model)
+            return "next", None
+
+        data = resp.json()
+
+        if resp.status_code == 401:
+            return "final", (
+                "PLAN: Authentication failed.\n"
+                "REASON: Groq rejected the API key (401 Unauthorized).\n"
+                "ACTION: Check your .env file.\n"
+                "FINAL ANSWER: Invalid API key. Make sure your .env has: GROQ_API_KEY=gsk_xxxx"
+            )
 
-    print(f"[DEBUG] GROQ_API_KEY loaded: {'YES - ' + api_key[:10] + '...' if api_key else 'NO - EMPTY'}")
+        if resp.status_code == 429:
+            return "final", (
+                "PLAN: Rate limit reached.\n"
+                "REASON: Too many requests sent to Groq API.\n"
+                "ACTION: Wait and retry.\n"
+                "FINAL ANSWER: Rate limit hit. Wait 30 seconds and try again."
+            )
 
-    if not api_key:
-        print("[DEBUG] No API key found — using mock response.")
-        return _mock_response(prompt)
-
-    # Groq model options in order of preference
-    models = ["llama-3.3-70b-versatile", "llama-3.1-8b-instant", "mixtral-8x7b-32768"]
-
-    for model in models:
-        try:
-            print(f"[DEBUG] Trying model: {model}")
-
-            resp = requests.post(
-                "https://api.groq.com/openai/v1/chat/completions",
-                headers={
-                    "Authorization": f"Bearer {api_key}",
-                    "Content-Type": "application/json"
-                },
-                json={
-                    "model": model,
-                    "messages": [{"role": "user", "content": prompt}],
-                    "max_tokens": 900,
-                    "temperature": 0.7
-                },
-                timeout=30
+        if resp.status_code == 404 or (isinstance(data, dict) and "model" in str(data.get("error", ""))):
+            log.debug("Model '%s' not found — trying next.", model)
+            return "next", None
+
+        if "error" in data:
+            err = data["error"] if isinstance(data["error"], str) else data["error"].get("message", str(data["error"]))
+            log.warning("API error: %s", err)
+            # If it's a model error, try next model
+            if "model" in err.lower():
+                return "next", None
+            return "final", (
+                f"PLAN: Groq API returned an error.\n"
+                f"REASON: {err}\n"
+                f"ACTION: Check your API key at console.groq.com.\n"
+                f"FINAL ANSWER: Groq error — {err}"
             )
 
-            print(f"[DEBUG] Status: {resp.status_code}")
-            print(f"[DEBUG] Body: {resp.text[:400]}")
-
-            data = resp.json()
-
-            if resp.status_code == 401:
-                return (
-                    "PLAN: Authentication failed.\n"
-                    "REASON: Groq rejected the API key (401 Unauthorized).\n"
-                    "ACTION: Check your .env file.\n"
-                    "FINAL ANSWER: Invalid API key. Make sure your .env has: GROQ_API_KEY=gsk_xxxx"
-                )
-
-            if resp.status_code == 429:
-                return (
-                    "PLAN: Rate limit reached.\n"
-                    "REASON: Too many requests sent to Groq API.\n"
-                    "ACTION: Wait and retry.\n"
-                    "FINAL ANSWER: Rate limit hit. Wait 30 seconds and try again."
-                )
-
-            if resp.status_code == 404 or (isinstance(data, dict) and "model" in str(data.get("error", ""))):
-                print(f"[DEBUG] Model '{model}' not found — trying next.")
-                continue
+        if "choices" not in data:
+            log.debug("No choices in response: %s", data)
+            return "next", None
+
+        _cb_success(model)
+        return "ok", data["choices"][0]["message"]["content"]
+
+    except requests.exceptions.Timeout:
+        log.warning("Request timed out on model %s.", model)
+        _cb_failure(model)
+        return "timeout", None
+
+    except requests.exceptions.ConnectionError as e:
+        log.warning("Connection error: %s", e)
+        return "final", (
+            "PLAN: Cannot connect to Groq API.\n"
+            f"REASON: {e}\n"
+            "ACTION: Check your internet connection.\n"
+            "FINAL ANSWER: Cannot reach api.groq.com — check your internet connection."
+        )
 
-            if "error" in data:
-                err = data["error"] if isinstance(data["error"], str) else data["error"].get("message", str(data["error"]))
-                print(f"[DEBUG] API error: {err}")
-                # If it's a model error, try next model
-                if "model" in err.lower():
-                    continue
-                return (
-                    f"PLAN: Groq API returned an error.\n"
-                    f"REASON: {err}\n"
-                    f"ACTION: Check your API key at console.groq.com.\n"
-                    f"FINAL ANSWER: Groq error — {err}"
-                )
-
-            if "choices" not in data:
-                print(f"[DEBUG] No choices in response: {data}")
-                continue
+    except Exception as e:
+        log.warning("Unexpected error on model %s: %s", model, e)
+        return "next", None
 
-            return data["choices"][0]["message"]["content"]
 
-        except requests.exceptions.Timeout:
-            print("[DEBUG] Request timed out.")
-            return (
-                "PLAN: Request timed out.\n"
-                "REASON: Groq API did not respond within 30 seconds.\n"
-                "ACTION: Check internet connection and try again.\n"
-                "FINAL ANSWER: Connection timed out. Please try again."
-            )
+def _run_attempt(model: str, prompt: str, params: dict) -> tuple[str, str | None]:
+    """Pool entry point; the caller has already taken an _LLM_SLOTS slot."""
+    try:
+        return _try_model(model, prompt, params)
+    finally:
+        _LLM_SLOTS.release()
 
-        except requests.exceptions.ConnectionError as e:
-            print(f"[DEBUG] Connection error: {e}")
-            return (
-                "PLAN: Cannot connect to Groq API.\n"
-                f"REASON: {e}\n"
-                "ACTION: Check your internet connection.\n"
-                "FINAL ANSWER: Cannot reach api.groq.com — check your internet connection."
-            )
 
-        except Exception as e:
-            print(f"[DEBUG] Unexpected error on model {model}: {e}")
+def _hedge_delay(params: dict) -> float:
+    return HEDGE_BASE_DELAY + params["max_tokens"] / HEDGE_TOKENS_PER_SEC
+
+
+def _available_models():
+    for model in GROQ_MODELS:
+        if _cb_allows(model):
+            yield model
+        else:
+            log.debug("Circuit open for model: %s — skipping.", model)
+
+
+def call_llm(prompt: str, intent: str = "chat") -> tuple[str, str | None, str | None]:
+    """
+    Return (response_text, model_used, fallback_from). model_used is "mock"
+    for canned replies and None for Groq error replies; fallback_from names the preferred model when it was
+    called or skipped by its breaker and another model answered instead.
+    """
+    api_key = os.environ.get("GROQ_API_KEY", "").strip()
+
+    if not api_key:
+        log.debug("No API key found — using mock response.")
+        return _mock_response(prompt), "mock", None
+
+    _set_auth(api_key)
+    params = _INTENT_PARAMS.get(intent, _DEFAULT_PARAMS)
+    hedge_delay = _hedge_delay(params)
+
+    # Deterministic calls are cached, but only answers from the preferred
+    # model: a fallback answer is not pinned for the TTL, so the next call
+    # gives the primary another chance.
+    primary = GROQ_MODELS[0]
+    cache_key = prompt_key(primary, prompt) if params["temperature"] == 0 else None
+    if cache_key:
+        cached = _RESPONSE_CACHE.get(cache_key)
+        if cached is not None:
+            log.debug("Cache hit for model: %s", primary)
+            return cached, primary, None
+
+    # Models are drawn lazily so a breaker's half-open probe is only claimed
+    # when that model is actually about to be called.
+    candidates = _available_models()
+    running = {}
+    exhausted = False
+
+    def launch(blocking: bool = True) -> bool:
+        # The slot is taken before the attempt is submitted, so the hedge
+        # clock never counts time spent queueing behind the concurrency cap.
+        nonlocal exhausted
+        if not _LLM_SLOTS.acquire(blocking=blocking):
+            return False
+        model = next(candidates, None)
+        if model is None:
+            _LLM_SLOTS.release()
+            exhausted = True
+            return False
+        running[_LLM_POOL.submit(_run_attempt, model, prompt, params)] = model
+        return True
+
+    launch()
+    timed_out = False
+    final = None
+
+    while running:
+        # While only one model is in flight, give it hedge_delay seconds
+        # before hedging with the next model in the chain. Once an attempt
+        # has ended the chain with a user-facing error, nothing new starts.
+        hedge = len(running) == 1 and not exhausted and final is None
+        done, _ = wait(running, timeout=hedge_delay if hedge else None, return_when=FIRST_COMPLETED)
+        if not done:
+            # Hedge only into spare capacity; with every slot busy, keep
+            # waiting on the current attempt rather than adding load.
+            if launch(blocking=False):
+                log.debug("No reply after %ss — hedged with next model.", hedge_delay)
             continue
 
-    print("[DEBUG] All models failed — using mock response.")
-    return _mock_response(prompt)
+        for fut in done:
+            model = running.pop(fut)
+            outcome, text = fut.result()
+            if outcome == "ok":
+                for loser in running:
+                    loser.cancel()
+                if cache_key and model == primary:
+                    _RESPONSE_CACHE.set(cache_key, text)
+                # Only live calls get here, so a non-primary answer means
+                # the primary failed, stalled, or had its breaker open.
+                return text, model, primary if model != primary else None
+            if outcome == "final":
+                # A 429 or connection error from one attempt must not discard
+                # an answer another attempt is still producing: hold the error
+                # and only return it if nothing in flight comes back "ok".
+                if final is None:
+                    final = text
+                continue
+            if outcome == "timeout":
+                timed_out = True
+            if not running and not exhausted and final is None:
+                launch()
+
+    if final is not None:
+        return final, None, None
+
+    if timed_out:
+        return (
+            "PLAN: Request timed out.\n"
+            "REASON: Groq API did not respond within 30 seconds.\n"
+            "ACTION: Check internet connection and try again.\n"
+            "FINAL ANSWER: Connection timed out. Please try again."
+        ), None, None
+
+    log.warning("All models failed — using mock response.")
+    return _mock_response(prompt), "mock", None
 
 
 # ---------------------------------------------------------------------------
 # Mock responses (fallback when API unavailable)
 # ---------------------------------------------------------------------------
 
+_MOCK_RESPONSES = {
+    "quiz": (
+        "PLAN: Generate a targeted knowledge quiz based on goal topics.\n"
+        "REASON: Active recall is the highest-leverage study method.\n"
+        "ACTION: Produce five multiple-choice questions.\n"
+        "FINAL ANSWER:\n\n"
+        "Knowledge Check\n\n"
+        "1. What is the time complexity of quicksort (average case)?\n"
+        "   A) O(n)   B) O(n log n)   C) O(n squared)   D) O(log n)\n\n"
+        "2. What does the bias-variance tradeoff describe?\n"
+        "   A) Speed vs accuracy   B) Model complexity vs generalization   C) Data size vs epochs   D) None\n\n"
+        "3. What does gradient descent minimize?\n"
+        "   A) Accuracy   B) Loss function   C) Weights   D) Learning rate\n\n"
+        "4. Which data structure does BFS use?\n"
+        "   A) Stack   B) Heap   C) Queue   D) Tree\n\n"
+        "5. What is regularization?\n"
+        "   A) Normalizing data   B) Penalizing complexity to reduce overfitting   C) Increasing epochs   D) Feature scaling\n\n"
+        "Answers: 1-B, 2-B, 3-B, 4-C, 5-B"
+    ),
+    "week_plan": (
+        "PLAN: Build a structured 7-day study schedule.\n"
+        "REASON: Even distribution prevents cramming.\n"
+        "ACTION: Assign tasks to each day.\n"
+        "FINAL ANSWER:\n\n"
+        "7-Day Study Plan\n\n"
+        "Monday    — Core theory review, 2 hours\n"
+        "Tuesday   — Problem set A, 2 hours\n"
+        "Wednesday — Video lecture + notes, 1.5 hours\n"
+        "Thursday  — Problem set B, 2 hours\n"
+        "Friday    — Mock test, 1 hour\n"
+        "Saturday  — Weak area revision, 2 hours\n"
+        "Sunday    — Light review + next week prep, 1 hour\n\n"
+        "Total: 11.5 hours. Consistency compounds."
+    ),
+    "reflect": (
+        "PLAN: Summarize week and extract insights.\n"
+        "REASON: Reflection closes the feedback loop.\n"
+        "ACTION: Evaluate logs and suggest corrections.\n"
+        "FINAL ANSWER:\n\n"
+        "Weekly Reflection\n\n"
+        "Consistent effort this week. Streak is holding.\n\n"
+        "What worked: Showing up daily.\n"
+        "What to improve: Front-load hard tasks earlier in the week.\n"
+        "Next priority: Tackle the highest-priority pending tasks first."
+    ),
+    "focus": (
+        "PLAN: Compare goals by deadline and pending work.\n"
+        "REASON: Every session must target the highest-leverage work.\n"
+        "ACTION: Recommend the best starting point.\n"
+        "FINAL ANSWER:\n\n"
+        "Focus Recommendation\n\n"
+        "Prioritize your most time-sensitive goal first.\n\n"
+        "Start with a single focused 50-minute session on one pending task.\n"
+        "Log hours afterward to protect your streak."
+    ),
+    "tired": (
+        "PLAN: Reduce workload to match energy level.\n"
+        "REASON: Fatigue produces low-quality work.\n"
+        "ACTION: Suggest lighter tasks.\n"
+        "FINAL ANSWER:\n\n"
+        "Low-Energy Plan\n\n"
+        "Keep it light today. Review existing notes or watch a short lecture.\n"
+        "Even 30 minutes of intentional review protects your streak.\n"
+        "Rest is part of the process."
+    ),
+    "default": (
+        "PLAN: Process query using full goal context.\n"
+        "REASON: Context-aware responses produce better outcomes.\n"
+        "ACTION: Deliver a targeted recommendation.\n"
+        "FINAL ANSWER:\n\n"
+        "Focus on your most urgent pending task first.\n"
+        "Work in 50-minute blocks with deliberate breaks.\n"
+        "Log study hours after each session to maintain your streak.\n\n"
+        "Precision and consistency beat intensity."
+    ),
+}
+
+# Paraphrase-friendly descriptions of each canned response, matched against
+# the user's message by embedding similarity when sentence-transformers is
+# installed. Anything below the threshold gets the "default" response.
+_ARCHETYPES = {
+    "quiz":      "quiz me, test my knowledge with practice questions",
+    "week_plan": "plan my week, make a weekly study schedule",
+    "reflect":   "reflect on my week, weekly review of how it went",
+    "focus":     "what should I focus on, suggest which goal to prioritize",
+    "tired":     "I am tired and exhausted, low energy, I need rest",
+}
+_SIMILARITY_THRESHOLD = 0.6
+_EMBED_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+_USER_MSG_RE = re.compile(r"^User message: (.*?)\n\nInstructions:", re.M | re.S)
+
+
+def _load_archetype_index():
+    """Load the embedding model and archetype vectors; None when unavailable."""
+    try:
+        from sentence_transformers import SentenceTransformer
+        model = SentenceTransformer(_EMBED_MODEL)
+        emb = model.encode(list(_ARCHETYPES.values()), normalize_embeddings=True)
+        return model, emb
+    except Exception as e:
+        log.info("Semantic mock matching unavailable: %s", e)
+        return None
+
+
+# Loaded once at import, and only in mock mode (no API key): loading torch and
+# the model can take seconds (or a download), which must not happen inside a
+# request on a gevent worker. With a key, the rare "all models failed" mock
+# reply falls back to keyword matching.
+_ARCHETYPE_INDEX = None if os.environ.get("GROQ_API_KEY", "").strip() else _load_archetype_index()
+
+
+def _match_archetype(message: str) -> str:
+    index = _ARCHETYPE_INDEX
+    if index:
+        model, emb = index
+        scores = emb @ model.encode(message, normalize_embeddings=True)
+        best = int(scores.argmax())
+        if scores[best] >= _SIMILARITY_THRESHOLD:
+            return list(_ARCHETYPES)[best]
+        return "default"
+
+    m = message.lower()
+    if "quiz" in m:
+        return "quiz"
+    if "week" in m or "plan" in m:
+        return "week_plan"
+    if "reflect" in m:
+        return "reflect"
+    if "focus" in m or "suggest" in m or "should i" in m:
+        return "focus"
+    if "tired" in m or "rest" in m:
+        return "tired"
+    return "default"
+
+
 def _mock_response(prompt: str) -> str:
-    p = prompt.lower()
-    if "quiz" in p:
-        return (
-            "PLAN: Generate a targeted knowledge quiz based on goal topics.\n"
-            "REASON: Active recall is the highest-leverage study method.\n"
-            "ACTION: Produce five multiple-choice questions.\n"
-            "FINAL ANSWER:\n\n"
-            "Knowledge Check\n\n"
-            "1. What is the time complexity of quicksort (average case)?\n"
-            "   A) O(n)   B) O(n log n)   C) O(n squared)   D) O(log n)\n\n"
-            "2. What does the bias-variance tradeoff describe?\n"
-            "   A) Speed vs accuracy   B) Model complexity vs generalization   C) Data size vs epochs   D) None\n\n"
-            "3. What does gradient descent minimize?\n"
-            "   A) Accuracy   B) Loss function   C) Weights   D) Learning rate\n\n"
-            "4. Which data structure does BFS use?\n"
-            "   A) Stack   B) Heap   C) Queue   D) Tree\n\n"
-            "5. What is regularization?\n"
-            "   A) Normalizing data   B) Penalizing complexity to reduce overfitting   C) Increasing epochs   D) Feature scaling\n\n"
-            "Answers: 1-B, 2-B, 3-B, 4-C, 5-B"
-        )
-    elif "week" in p or "plan" in p:
-        return (
-            "PLAN: Build a structured 7-day study schedule.\n"
-            "REASON: Even distribution prevents cramming.\n"
-            "ACTION: Assign tasks to each day.\n"
-            "FINAL ANSWER:\n\n"
-            "7-Day Study Plan\n\n"
-            "Monday    — Core theory review, 2 hours\n"
-            "Tuesday   — Problem set A, 2 hours\n"
-            "Wednesday — Video lecture + notes, 1.5 hours\n"
-            "Thursday  — Problem set B, 2 hours\n"
-            "Friday    — Mock test, 1 hour\n"
-            "Saturday  — Weak area revision, 2 hours\n"
-            "Sunday    — Light review + next week prep, 1 hour\n\n"
-            "Total: 11.5 hours. Consistency compounds."
-        )
-    elif "reflect" in p:
-        return (
-            "PLAN: Summarize week and extract insights.\n"
-            "REASON: Reflection closes the feedback loop.\n"
-            "ACTION: Evaluate logs and suggest corrections.\n"
-            "FINAL ANSWER:\n\n"
-            "Weekly Reflection\n\n"
-            "Consistent effort this week. Streak is holding.\n\n"
-            "What worked: Showing up daily.\n"
-            "What to improve: Front-load hard tasks earlier in the week.\n"
-            "Next priority: Tackle the highest-priority pending tasks first."
-        )
-    elif "focus" in p or "suggest" in p or "should i" in p:
-        return (
-            "PLAN: Compare goals by deadline and pending work.\n"
-            "REASON: Every session must target the highest-leverage work.\n"
-            "ACTION: Recommend the best starting point.\n"
-            "FINAL ANSWER:\n\n"
-            "Focus Recommendation\n\n"
-            "Prioritize your most time-sensitive goal first.\n\n"
-            "Start with a single focused 50-minute session on one pending task.\n"
-            "Log hours afterward to protect your streak."
-        )
-    elif "tired" in p or "rest" in p:
-        return (
-            "PLAN: Reduce workload to match energy level.\n"
-            "REASON: Fatigue produces low-quality work.\n"
-            "ACTION: Suggest lighter tasks.\n"
-            "FINAL ANSWER:\n\n"
-            "Low-Energy Plan\n\n"
-            "Keep it light today. Review existing notes or watch a short lecture.\n"
-            "Even 30 minutes of intentional review protects your streak.\n"
-            "Rest is part of the process."
-        )
-    else:
-        return (
-            "PLAN: Process query using full goal context.\n"
-            "REASON: Context-aware responses produce better outcomes.\n"
-            "ACTION: Deliver a targeted recommendation.\n"
-            "FINAL ANSWER:\n\n"
-            "Focus on your most urgent pending task first.\n"
-            "Work in 50-minute blocks with deliberate breaks.\n"
-            "Log study hours after each session to maintain your streak.\n\n"
-            "Precision and consistency beat intensity."
-        )
+    m = _USER_MSG_RE.search(prompt)
+    message = m.group(1) if m else prompt
+    return _MOCK_RESPONSES[_match_archetype(message)]
 
 
 # ---------------------------------------------------------------------------
 # Intent detection
 # ---------------------------------------------------------------------------
 
+# Checked in order — the first matching rule wins. Kept as separate patterns
+# on purpose: each one gets re's literal-prefix scan, and a single combined
+# alternation measured 2-10x slower on typical chat-length messages.
+_INTENT_RULES = [
+    (re.compile(r"add.*(goal|target)|new goal"),                 "add_goal"),
+    (re.compile(r"add.*(task|todo)"),                            "add_task"),
+    (re.compile(r"mark.*done|complete.*task|finish.*task"),      "mark_task"),
+    (re.compile(r"\d+\s*(hour|hr)|studied|log.*hour"),           "log_hours"),
+    (re.compile(r"feel|mood|i am|i'm"),                          "update_mood"),
+    (re.compile(r"quiz|test me|practice question"),              "quiz"),
+    (re.compile(r"plan.*week|week.*plan"),                       "plan_week"),
+    (re.compile(r"study.*plan|plan.*study"),                     "study_plan"),
+    (re.compile(r"reflect|weekly review"),                       "reflect"),
+    (re.compile(r"focus|what should|suggest|priority|which goal"), "suggest"),
+]
+
+_HOURS_RE = re.compile(r"(\d+(?:\.\d+)?)\s*(?:hour|hr|h)", re.I)
+_TASK_RE = re.compile(r"(?:task|todo)[:\s]+(.+)", re.I)
+_ADD_TASK_CLEAN_RE = re.compile(r"add\s+(a\s+)?task(\s+to\s+\w+(\s+\w+)?\s+goal)?:?\s*", re.I)
+
+# Tuple, not a set: when several moods appear the earliest listed wins.
+_MOODS = ("tired", "motivated", "stressed", "happy", "focused",
+          "anxious", "energetic", "excited", "bored", "sad")
+
+
 def detect_intent(text: str) -> str:
     t = text.lower()
-    if re.search(r"add.*(goal|target)|new goal", t):              return "add_goal"
-    if re.search(r"add.*(task|todo)", t):                         return "add_task"
-    if re.search(r"mark.*done|complete.*task|finish.*task", t):   return "mark_task"
-    if re.search(r"\d+\s*(hour|hr)|studied|log.*hour", t):        return "log_hours"
-    if re.search(r"feel|mood|i am|i'm", t):                       return "update_mood"
-    if re.search(r"quiz|test me|practice question", t):           return "quiz"
-    if re.search(r"plan.*week|week.*plan", t):                    return "plan_week"
-    if re.search(r"study.*plan|plan.*study", t):                  return "study_plan"
-    if re.search(r"reflect|weekly review", t):                    return "reflect"
-    if re.search(r"focus|what should|suggest|priority|which goal", t): return "suggest"
+    for pat, name in _INTENT_RULES:
+        if pat.search(t):
+            return name
     return "chat"
 
 
 def _parse_hours(text: str) -> float:
-    m = re.search(r"(\d+(?:\.\d+)?)\s*(?:hour|hr|h)", text, re.I)
+    m = _HOURS_RE.search(text)
     return float(m.group(1)) if m else 1.0
 
 
 def _parse_mood(text: str) -> str:
-    for mood in ["tired", "motivated", "stressed", "happy", "focused",
-                 "anxious", "energetic", "excited", "bored", "sad"]:
-        if mood in text.lower():
-            return mood
-    return "neutral"
+    t = text.lower()
+    return next((mood for mood in _MOODS if mood in t), "neutral")
 
 
 def _find_goal_id(text: str, mem: dict) -> int:
@@ -250,43 +526,31 @@ def _find_goal_id(text: str, mem: dict) -> int:
             if len(word) > 3 and word in t:
                 return g["id"]
     best, min_d = None, float("inf")
+    today = date.today()
     for g in mem["goals"]:
         if g["status"] == "active":
-            _, days = calculate_priority(g)
+            _, days = calculate_priority(g, today)
             if days < min_d:
                 min_d, best = days, g["id"]
     return best or (mem["goals"][0]["id"] if mem["goals"] else 1)
 
 
 def _parse_task_text(text: str) -> str:
-    m = re.search(r"(?:task|todo)[:\s]+(.+)", text, re.I)
+    m = _TASK_RE.search(text)
     if m:
         return m.group(1).strip()
-    cleaned = re.sub(r"add\s+(a\s+)?task(\s+to\s+\w+(\s+\w+)?\s+goal)?:?\s*", "", text, flags=re.I)
-    return cleaned.strip()
+    return _ADD_TASK_CLEAN_RE.sub("", text).strip()
 
 
 # ---------------------------------------------------------------------------
 # Build master LLM prompt
 # ---------------------------------------------------------------------------
 
-def _build_prompt(user_input: str, tool_context: dict, ctx: dict) -> str:
-    goals_lines = ""
-    for g in ctx["goals"]:
-        goals_lines += (
-            f"\n  [{g['priority']}] {g['title']} | "
-            f"{g['days_left']}d left | {g['progress']}% done | "
-            f"Pending: {g['pending_tasks']}"
-        )
+_PROMPT_TMPL = """You are an AI Productivity Agent embedded in a professional second-brain application.
 
-    logs_line = ", ".join(f"{l['date']}: {l['hours']}h" for l in ctx["recent_logs"][-5:])
-    ctx_json = f"\nTool result: {json.dumps(tool_context)}" if tool_context else ""
-
-    return f"""You are an AI Productivity Agent embedded in a professional second-brain application.
-
-User: {ctx['name']}
-Mood: {ctx['mood']}
-Study streak: {ctx['streak']} days
+User: {name}
+Mood: {mood}
+Study streak: {streak} days
 
 Active Goals:{goals_lines}
 
@@ -298,7 +562,7 @@ User message: {user_input}
 Instructions:
 - Think step by step.
 - Consider all goals and compare priorities.
-- Adapt tone to mood ({ctx['mood']}): if tired, suggest lighter work; if motivated, push harder tasks.
+- Adapt tone to mood ({mood}): if tired, suggest lighter work; if motivated, push harder tasks.
 - Be direct and professional. No emojis. No filler phrases.
 - Always reference the streak positively.
 
@@ -311,38 +575,64 @@ FINAL ANSWER:
 """
 
 
+def _build_prompt(user_input: str, tool_context: dict, ctx: dict) -> str:
+    goals_lines = "".join(
+        f"\n  [{g['priority']}] {g['title']} | "
+        f"{g['days_left']}d left | {g['progress']}% done | "
+        f"Pending: {g['pending_tasks']}"
+        for g in ctx["goals"]
+    )
+    logs_line = ", ".join(f"{l['date']}: {l['hours']}h" for l in ctx["recent_logs"][-5:])
+    ctx_json = f"\nTool result: {json.dumps(tool_context)}" if tool_context else ""
+
+    return _PROMPT_TMPL.format(
+        name=ctx["name"],
+        mood=ctx["mood"],
+        streak=ctx["streak"],
+        goals_lines=goals_lines,
+        logs_line=logs_line,
+        ctx_json=ctx_json,
+        user_input=user_input,
+    )
+
+
 # ---------------------------------------------------------------------------
 # Main entry point
 # ---------------------------------------------------------------------------
 
 def run_agent(user_input: str) -> dict:
-    mem = load_memory()
     intent = detect_intent(user_input)
     tool_result = {}
 
-    if intent == "log_hours":
-        hours = _parse_hours(user_input)
-        tool_result = log_study_hours(hours)
+    # One load and at most one save per turn; the tools share this `mem`.
+    # The LLM call happens after the session so it never holds the lock.
+    with memory_session() as mem:
+        if intent == "log_hours":
+            hours = _parse_hours(user_input)
+            tool_result = log_study_hours(hours, mem=mem)
+
+        elif intent == "update_mood":
+            mood = _parse_mood(user_input)
+            tool_result = update_mood(mood, mem=mem)
 
-    elif intent == "update_mood":
-        mood = _parse_mood(user_input)
-        tool_result = update_mood(mood)
+        elif intent == "add_goal":
+            tool_result = {"note": "Use the Goals panel to add goals with full details."}
 
-    elif intent == "add_goal":
-        tool_result = {"note": "Use the Goals panel to add goals with full details."}
+        elif intent == "add_task":
+            goal_id = _find_goal_id(user_input, mem)
+            task_text = _parse_task_text(user_input)
+            if task_text:
+                tool_result = add_task(goal_id, task_text, mem=mem) or {}
 
-    elif intent == "add_task":
-        goal_id = _find_goal_id(user_input, mem)
-        task_text = _parse_task_text(user_input)
-        if task_text:
-            tool_result = add_task(goal_id, task_text) or {}
+        ctx = get_agent_context(mem=mem)
 
-    ctx = get_agent_context()
     prompt = _build_prompt(user_input, tool_result, ctx)
-    response = call_llm(prompt)
+    response, model, fallback_from = call_llm(prompt, intent)
 
     return {
         "response": response,
         "intent": intent,
         "tool_result": tool_result,
+        "model": model,
+        "fallback_from": fallback_from,
     }
\ No newline at end of file
@@ -3,16 +3,27 @@ app.py
 Flask server — all HTTP routes for the AI Second Brain application.
 """
 
+# Patch before anything imports requests/socket so LLM calls yield to other
+# requests instead of blocking the worker (gunicorn's gevent worker does this
+# too; doing it here keeps `python app.py` behaving the same way).
+from gevent import monkey
+monkey.patch_all()
+
+import logging
+from datetime import date
+
 from flask import Flask, request, jsonify, render_template
 from agent import run_agent
 from tools import (
-    get_analytics, load_memory,
+    get_analytics, load_memory, memory_lock, memory_version,
     add_goal, edit_goal, delete_goal, mark_goal_complete,
     add_task, edit_task, toggle_task, delete_task,
     get_all_goals, get_tasks,
     log_study_hours, update_mood,
 )
 
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
 app = Flask(__name__)
 
 
@@ -29,9 +40,28 @@ def index():
 # Analytics
 # ---------------------------------------------------------------------------
 
+def _analytics_etag() -> str:
+    # The payload only changes when memory.json does, or when the day rolls
+    # over (days_left / the 7-day chart shift).
+    return f"{memory_version():x}-{date.today():%Y%m%d}"
+
+
 @app.route("/api/analytics")
 def api_analytics():
-    return jsonify(get_analytics())
+    tag = _analytics_etag()
+    if request.if_none_match.contains(tag):
+        return "", 304, {"ETag": f'"{tag}"'}
+
+    # Body and tag come from the same locked snapshot: get_analytics may save
+    # recalculated goals, and another worker must not write before the tag is read.
+    with memory_lock():
+        data = get_analytics()
+        tag = _analytics_etag()
+    resp = jsonify(data)
+    resp.set_etag(tag)
+    # Always revalidate — the UI refetches right after every change.
+    resp.headers["Cache-Control"] = "private, no-cache"
+    return resp
 
 
 # ---------------------------------------------------------------------------
@@ -157,7 +187,13 @@ def api_chat():
     if not msg:
         return jsonify({"error": "message required"}), 400
     result = run_agent(msg)
-    return jsonify(result)
+    resp = jsonify(result)
+    # Left off for Groq error replies (401/429/timeout/connection errors).
+    if result["model"]:
+        resp.headers["X-Model-Used"] = result["model"]
+    if result["fallback_from"]:
+        resp.headers["X-Fallback-From"] = result["fallback_from"]
+    return resp
 
 
 # ---------------------------------------------------------------------------
@@ -172,4 +208,5 @@ def api_memory():
 # ---------------------------------------------------------------------------
 
 if __name__ == "__main__":
-    app.run(debug=True, port=5000)
+    # Threaded so a slow /api/chat call does not block the dashboard routes.
+    app.run(debug=True, port=5000, threaded=True)
@@ -0,0 +1,46 @@
+"""
+cache.py
+In-process LRU cache with per-entry TTL — used to skip repeat LLM calls.
+"""
+
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """Thread-safe LRU mapping; entries expire `ttl` seconds after insert."""
+
+    def __init__(self, maxsize: int = 256, ttl: float = 3600.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            value, stored_at = entry
+            if time.monotonic() - stored_at > self.ttl:
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: str, value) -> None:
+        with self._lock:
+            self._data[key] = (value, time.monotonic())
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+
+def prompt_key(model: str, prompt: str) -> str:
+    return hashlib.sha256(f"{model}|{prompt}".encode()).hexdigest()
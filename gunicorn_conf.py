@@ -0,0 +1,28 @@
+"""
+gunicorn_conf.py
+Production server settings — run with: gunicorn -c gunicorn_conf.py app:app
+"""
+import os
+
+bind = "0.0.0.0:5000"
+
+# gevent workers make the blocking Groq calls cooperative, so one slow
+# /api/chat no longer holds up the dashboard routes on the same worker.
+worker_class = "gevent"
+workers = 4
+worker_connections = 100
+
+# agent.py's LLM concurrency cap, circuit breaker and response cache live in
+# each worker process, so split the account-wide Groq cap between workers
+# rather than letting every worker open MAX_CONCURRENT_LLM calls of its own.
+# An explicit MAX_CONCURRENT_LLM in the environment still wins.
+GROQ_MAX_CONCURRENT = int(os.environ.get("GROQ_MAX_CONCURRENT", "8"))
+raw_env = []
+if "MAX_CONCURRENT_LLM" not in os.environ:
+    raw_env.append(f"MAX_CONCURRENT_LLM={max(1, GROQ_MAX_CONCURRENT // workers)}")
+
+# With gevent workers this is the worker heartbeat limit, not a per-request
+# one: a stalled worker loop gets restarted, but a long /api/chat (hedge
+# delay plus up to two 30s read timeouts when every model stalls) is not cut
+# off here.
+timeout = 60
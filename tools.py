@@ -3,69 +3,202 @@ tools.py
 All data-layer functions. Every function reads/writes memory.json.
 """
 
-import json
-from datetime import date, datetime, timedelta
+import contextlib
+import functools
+import os
+import threading
+import orjson
+from datetime import date, timedelta
+
+try:
+    import fcntl
+except ImportError:  # Windows: fall back to the in-process lock only
+    fcntl = None
 
 MEMORY_FILE = "memory.json"
+LOCK_FILE = MEMORY_FILE + ".lock"
+
+# Parsed memory.json, reused for as long as the file's mtime is unchanged.
+# load_memory hands out this shared dict, so load-modify-save sequences run
+# under memory_session() / memory_lock() to keep requests from interleaving.
+_MEM_CACHE = {"data": None, "mtime": 0}
+_RLOCK = threading.RLock()
+_FLOCK = {"fd": None, "depth": 0}
+
+# id -> goal dict for the cached document; rebuilt lazily whenever the goals
+# list is replaced or changes length (add/delete), so lookups stay O(1).
+_GOAL_INDEX = {"goals": None, "size": 0, "by_id": {}}
 
 
 # ---------------------------------------------------------------------------
 # Core I/O
 # ---------------------------------------------------------------------------
 
+@contextlib.contextmanager
+def memory_lock():
+    """
+    Reentrant lock around a load-modify-save of memory.json: the in-process
+    RLock for request threads, plus an exclusive flock on LOCK_FILE (taken at
+    the outermost level only) for other gunicorn worker processes.
+    """
+    with _RLOCK:
+        if _FLOCK["depth"] == 0 and fcntl:
+            fd = os.open(LOCK_FILE, os.O_RDWR | os.O_CREAT, 0o644)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            _FLOCK["fd"] = fd
+        _FLOCK["depth"] += 1
+        try:
+            yield
+        finally:
+            _FLOCK["depth"] -= 1
+            if _FLOCK["depth"] == 0 and _FLOCK["fd"] is not None:
+                fcntl.flock(_FLOCK["fd"], fcntl.LOCK_UN)
+                os.close(_FLOCK["fd"])
+                _FLOCK["fd"] = None
+
+
+def _locked(fn):
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with memory_lock():
+            return fn(*args, **kwargs)
+    return wrapper
+
+
+def _migrate(mem: dict) -> dict:
+    """Upgrade older memory.json layouts in place."""
+    # study_logs used to be a list of {"date", "hours"} records.
+    if isinstance(mem.get("study_logs"), list):
+        logs = {}
+        for l in mem["study_logs"]:
+            logs[l["date"]] = logs.get(l["date"], 0) + l["hours"]
+        mem["study_logs"] = logs
+    return mem
+
+
+def memory_version() -> int:
+    """Changes whenever memory.json is rewritten (by any process)."""
+    return os.stat(MEMORY_FILE).st_mtime_ns
+
+
+@_locked
 def load_memory() -> dict:
-    with open(MEMORY_FILE, "r") as f:
-        return json.load(f)
+    mtime = memory_version()
+    if _MEM_CACHE["data"] is None or _MEM_CACHE["mtime"] != mtime:
+        with open(MEMORY_FILE, "rb") as f:
+            _MEM_CACHE["data"] = _migrate(orjson.loads(f.read()))
+        _MEM_CACHE["mtime"] = mtime
+    return _MEM_CACHE["data"]
 
 
+@_locked
 def save_memory(mem: dict) -> None:
-    with open(MEMORY_FILE, "w") as f:
-        json.dump(mem, f, indent=2)
+    # Write to a temp file and swap it in, so a crash or a concurrent reader
+    # never sees a truncated memory.json.
+    tmp = MEMORY_FILE + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(orjson.dumps(mem, option=orjson.OPT_INDENT_2))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, MEMORY_FILE)
+    _MEM_CACHE["data"] = mem
+    _MEM_CACHE["mtime"] = memory_version()
+
+
+@contextlib.contextmanager
+def memory_session(mem: dict | None = None):
+    """
+    Yield the memory dict for one load-modify-save. A `mem` passed in belongs
+    to an outer session and is handed straight through. Otherwise memory is
+    loaded under memory_lock() and written back on exit only if it changed.
+    """
+    if mem is not None:
+        yield mem
+        return
+    with memory_lock():
+        mem = load_memory()
+        before = orjson.dumps(mem)
+        yield mem
+        if orjson.dumps(mem) != before:   # dirty
+            save_memory(mem)
 
 
 def _get_goal(mem: dict, goal_id: int) -> dict | None:
-    for g in mem["goals"]:
-        if g["id"] == goal_id:
-            return g
-    return None
+    goals = mem["goals"]
+    if _GOAL_INDEX["goals"] is not goals or _GOAL_INDEX["size"] != len(goals):
+        _GOAL_INDEX["by_id"] = {g["id"]: g for g in goals}
+        _GOAL_INDEX["goals"] = goals
+        _GOAL_INDEX["size"] = len(goals)
+    return _GOAL_INDEX["by_id"].get(goal_id)
+
+
+def _get_task(goal: dict, task_id: int) -> dict | None:
+    return next((t for t in goal["tasks"] if t["id"] == task_id), None)
 
 
 # ---------------------------------------------------------------------------
 # Priority engine
 # ---------------------------------------------------------------------------
 
-def calculate_priority(goal: dict) -> tuple[str, int]:
+@functools.lru_cache(maxsize=512)
+def _parse_date(s: str) -> date:
+    """Parse a YYYY-MM-DD string; much cheaper than strptime and memoised."""
+    y, m, d = map(int, s.split("-"))
+    return date(y, m, d)
+
+
+def _priority_for(days_left: int, pending: int) -> str:
+    if days_left < 0:
+        return "OVERDUE"
+    elif days_left < 7:
+        return "CRITICAL"
+    elif days_left < 15:
+        return "HIGH"
+    elif days_left < 30 or pending > 3:
+        return "MEDIUM"
+    else:
+        return "LOW"
+
+
+def calculate_priority(goal: dict, today: date | None = None) -> tuple[str, int]:
     """Return (priority_label, days_left)."""
     try:
-        deadline = datetime.strptime(goal["deadline"], "%Y-%m-%d").date()
-        days_left = (deadline - date.today()).days
+        deadline = _parse_date(goal["deadline"])
+        days_left = (deadline - (today or date.today())).days
         pending = sum(1 for t in goal["tasks"] if t["status"] == "pending")
-
-        if days_left < 0:
-            return "OVERDUE", days_left
-        elif days_left < 7:
-            return "CRITICAL", days_left
-        elif days_left < 15:
-            return "HIGH", days_left
-        elif days_left < 30 or pending > 3:
-            return "MEDIUM", days_left
-        else:
-            return "LOW", days_left
+        return _priority_for(days_left, pending), days_left
     except Exception:
         return "MEDIUM", 999
 
 
-def recalc_goal(goal: dict) -> dict:
+def _recalc_bulk(goals: list, today: date):
+    """
+    Recalculate progress and priority of every goal in place, walking each
+    goal's tasks once. Yields (goal, tasks_done, pending_task_texts, days_left).
+    """
+    for g in goals:
+        tasks = g.get("tasks", [])
+        done = 0
+        pending = []
+        for t in tasks:
+            if t["status"] == "completed":
+                done += 1
+            elif t["status"] == "pending":
+                pending.append(t["task"])
+        g["progress"] = round((done / len(tasks)) * 100) if tasks else 0
+
+        try:
+            days_left = (_parse_date(g["deadline"]) - today).days
+            g["priority"] = _priority_for(days_left, len(pending))
+        except Exception:
+            days_left = 999
+            g["priority"] = "MEDIUM"
+        yield g, done, pending, days_left
+
+
+def recalc_goal(goal: dict, today: date | None = None) -> dict:
     """Recalculate progress and priority in-place, return goal."""
-    tasks = goal.get("tasks", [])
-    if tasks:
-        done = sum(1 for t in tasks if t["status"] == "completed")
-        goal["progress"] = round((done / len(tasks)) * 100)
-    else:
-        goal["progress"] = 0
-
-    priority, _ = calculate_priority(goal)
-    goal["priority"] = priority
+    next(_recalc_bulk([goal], today or date.today()))
     return goal
 
 
@@ -74,160 +207,145 @@ def recalc_goal(goal: dict) -> dict:
 # ---------------------------------------------------------------------------
 
 def get_all_goals() -> list:
-    mem = load_memory()
-    for g in mem["goals"]:
-        recalc_goal(g)
-    save_memory(mem)
-    return mem["goals"]
+    with memory_session() as mem:
+        for _ in _recalc_bulk(mem["goals"], date.today()):
+            pass
+        return mem["goals"]
 
 
 def add_goal(title: str, deadline: str) -> dict:
-    mem = load_memory()
-    new_id = max((g["id"] for g in mem["goals"]), default=0) + 1
-    goal = {
-        "id": new_id,
-        "title": title.strip(),
-        "deadline": deadline,
-        "priority": "MEDIUM",
-        "status": "active",
-        "tasks": [],
-        "progress": 0
-    }
-    recalc_goal(goal)
-    mem["goals"].append(goal)
-    save_memory(mem)
-    return goal
+    with memory_session() as mem:
+        new_id = max((g["id"] for g in mem["goals"]), default=0) + 1
+        goal = {
+            "id": new_id,
+            "title": title.strip(),
+            "deadline": deadline,
+            "priority": "MEDIUM",
+            "status": "active",
+            "tasks": [],
+            "progress": 0
+        }
+        recalc_goal(goal)
+        mem["goals"].append(goal)
+        return goal
 
 
 def edit_goal(goal_id: int, title: str | None = None, deadline: str | None = None) -> dict | None:
-    mem = load_memory()
-    goal = _get_goal(mem, goal_id)
-    if not goal:
-        return None
-    if title:
-        goal["title"] = title.strip()
-    if deadline:
-        goal["deadline"] = deadline
-    recalc_goal(goal)
-    save_memory(mem)
-    return goal
+    with memory_session() as mem:
+        goal = _get_goal(mem, goal_id)
+        if not goal:
+            return None
+        if title:
+            goal["title"] = title.strip()
+        if deadline:
+            goal["deadline"] = deadline
+        recalc_goal(goal)
+        return goal
 
 
 def delete_goal(goal_id: int) -> bool:
-    mem = load_memory()
-    before = len(mem["goals"])
-    mem["goals"] = [g for g in mem["goals"] if g["id"] != goal_id]
-    save_memory(mem)
-    return len(mem["goals"]) < before
+    with memory_session() as mem:
+        before = len(mem["goals"])
+        mem["goals"] = [g for g in mem["goals"] if g["id"] != goal_id]
+        return len(mem["goals"]) < before
 
 
 def mark_goal_complete(goal_id: int) -> dict | None:
-    mem = load_memory()
-    goal = _get_goal(mem, goal_id)
-    if not goal:
-        return None
-    goal["status"] = "completed"
-    # mark all tasks done
-    for t in goal["tasks"]:
-        t["status"] = "completed"
-    recalc_goal(goal)
-    save_memory(mem)
-    return goal
+    with memory_session() as mem:
+        goal = _get_goal(mem, goal_id)
+        if not goal:
+            return None
+        goal["status"] = "completed"
+        # mark all tasks done
+        for t in goal["tasks"]:
+            t["status"] = "completed"
+        recalc_goal(goal)
+        return goal
 
 
 # ---------------------------------------------------------------------------
 # Task CRUD
 # ---------------------------------------------------------------------------
 
+@_locked
 def get_tasks(goal_id: int) -> list:
     mem = load_memory()
     goal = _get_goal(mem, goal_id)
     return goal["tasks"] if goal else []
 
 
-def add_task(goal_id: int, task_text: str) -> dict | None:
-    mem = load_memory()
-    goal = _get_goal(mem, goal_id)
-    if not goal:
-        return None
-    new_task_id = max((t["id"] for t in goal["tasks"]), default=0) + 1
-    task = {"id": new_task_id, "task": task_text.strip(), "status": "pending"}
-    goal["tasks"].append(task)
-    recalc_goal(goal)
-    save_memory(mem)
-    return task
+def add_task(goal_id: int, task_text: str, mem: dict | None = None) -> dict | None:
+    with memory_session(mem) as mem:
+        goal = _get_goal(mem, goal_id)
+        if not goal:
+            return None
+        new_task_id = max((t["id"] for t in goal["tasks"]), default=0) + 1
+        task = {"id": new_task_id, "task": task_text.strip(), "status": "pending"}
+        goal["tasks"].append(task)
+        recalc_goal(goal)
+        return task
 
 
 def edit_task(goal_id: int, task_id: int, text: str) -> dict | None:
-    mem = load_memory()
-    goal = _get_goal(mem, goal_id)
-    if not goal:
-        return None
-    for t in goal["tasks"]:
-        if t["id"] == task_id:
-            t["task"] = text.strip()
-            save_memory(mem)
-            return t
-    return None
+    with memory_session() as mem:
+        goal = _get_goal(mem, goal_id)
+        if not goal:
+            return None
+        t = _get_task(goal, task_id)
+        if not t:
+            return None
+        t["task"] = text.strip()
+        return t
 
 
 def toggle_task(goal_id: int, task_id: int) -> dict | None:
-    mem = load_memory()
-    goal = _get_goal(mem, goal_id)
-    if not goal:
-        return None
-    for t in goal["tasks"]:
-        if t["id"] == task_id:
-            t["status"] = "completed" if t["status"] == "pending" else "pending"
-            recalc_goal(goal)
-            save_memory(mem)
-            return t
-    return None
+    with memory_session() as mem:
+        goal = _get_goal(mem, goal_id)
+        if not goal:
+            return None
+        t = _get_task(goal, task_id)
+        if not t:
+            return None
+        t["status"] = "completed" if t["status"] == "pending" else "pending"
+        recalc_goal(goal)
+        return t
 
 
 def delete_task(goal_id: int, task_id: int) -> bool:
-    mem = load_memory()
-    goal = _get_goal(mem, goal_id)
-    if not goal:
-        return False
-    before = len(goal["tasks"])
-    goal["tasks"] = [t for t in goal["tasks"] if t["id"] != task_id]
-    recalc_goal(goal)
-    save_memory(mem)
-    return len(goal["tasks"]) < before
+    with memory_session() as mem:
+        goal = _get_goal(mem, goal_id)
+        if not goal:
+            return False
+        before = len(goal["tasks"])
+        goal["tasks"] = [t for t in goal["tasks"] if t["id"] != task_id]
+        recalc_goal(goal)
+        return len(goal["tasks"]) < before
 
 
 # ---------------------------------------------------------------------------
 # Study log & streak
 # ---------------------------------------------------------------------------
 
-def log_study_hours(hours: float) -> dict:
-    mem = load_memory()
-    today = str(date.today())
-    yesterday = str(date.today() - timedelta(days=1))
-    dates_logged = {log["date"] for log in mem["study_logs"]}
+def log_study_hours(hours: float, mem: dict | None = None) -> dict:
+    with memory_session(mem) as mem:
+        now = date.today()
+        today = str(now)
+        yesterday = str(now - timedelta(days=1))
+        logs = mem["study_logs"]
 
-    for log in mem["study_logs"]:
-        if log["date"] == today:
-            log["hours"] += hours
-            save_memory(mem)
-            return {"date": today, "total_today": log["hours"], "streak": mem["streak"]}
+        if today in logs:
+            logs[today] += hours
+            return {"date": today, "total_today": logs[today], "streak": mem["streak"]}
 
-    if yesterday in dates_logged:
-        mem["streak"] += 1
-    else:
-        mem["streak"] = 1
+        mem["streak"] = mem["streak"] + 1 if yesterday in logs else 1
+        logs[today] = hours
+        return {"date": today, "hours": hours, "streak": mem["streak"]}
 
-    mem["study_logs"].append({"date": today, "hours": hours})
-    save_memory(mem)
-    return {"date": today, "hours": hours, "streak": mem["streak"]}
 
-
-def update_mood(mood: str) -> dict:
-    mem = load_memory()
-    mem["mood"] = mood.lower().strip()
-    save_memory(mem)
-    return {"mood": mem["mood"]}
+def update_mood(mood: str, mem: dict | None = None) -> dict:
+    with memory_session(mem) as mem:
+        mem["mood"] = mood.lower().strip()
+        return {"mood": mem["mood"]}
 
 
 # ---------------------------------------------------------------------------
@@ -235,90 +353,78 @@ def update_mood(mood: str) -> dict:
 # ---------------------------------------------------------------------------
 
 def get_analytics() -> dict:
-    mem = load_memory()
-    today = date.today()
-    week_ago = today - timedelta(days=7)
-
-    week_hours = sum(
-        l["hours"] for l in mem["study_logs"]
-        if datetime.strptime(l["date"], "%Y-%m-%d").date() >= week_ago
-    )
-    total_hours = sum(l["hours"] for l in mem["study_logs"])
-
-    goals_data = []
-    most_urgent = None
-    min_days = float("inf")
-
-    for g in mem["goals"]:
-        recalc_goal(g)
-        priority, days_left = calculate_priority(g)
-        done = sum(1 for t in g["tasks"] if t["status"] == "completed")
-        total = len(g["tasks"])
-        goals_data.append({
-            "id": g["id"],
-            "title": g["title"],
-            "deadline": g["deadline"],
-            "priority": priority,
-            "days_left": days_left,
-            "progress": g["progress"],
-            "status": g["status"],
-            "tasks_done": done,
-            "total_tasks": total,
-        })
-        if days_left < min_days and g["status"] == "active":
-            min_days = days_left
-            most_urgent = g["title"]
-
-    save_memory(mem)
-
-    # Weekly logs for chart
-    log_chart = []
-    for i in range(6, -1, -1):
-        d = str(today - timedelta(days=i))
-        hrs = next((l["hours"] for l in mem["study_logs"] if l["date"] == d), 0)
-        log_chart.append({"date": d, "hours": hrs})
-
-    return {
-        "name": mem["name"],
-        "mood": mem["mood"],
-        "streak": mem["streak"],
-        "week_hours": week_hours,
-        "total_hours": total_hours,
-        "goals": goals_data,
-        "most_urgent": most_urgent,
-        "log_chart": log_chart,
-        "active_count": sum(1 for g in mem["goals"] if g["status"] == "active"),
-        "completed_count": sum(1 for g in mem["goals"] if g["status"] == "completed"),
-    }
+    with memory_session() as mem:
+        today = date.today()
+        week_ago = str(today - timedelta(days=7))
+
+        # ISO dates compare correctly as strings.
+        logs_by_date = mem["study_logs"]
+        week_hours = sum(h for d, h in logs_by_date.items() if d >= week_ago)
+        total_hours = sum(logs_by_date.values())
+
+        goals_data = []
+        most_urgent = None
+        min_days = float("inf")
+
+        for g, done, _, days_left in _recalc_bulk(mem["goals"], today):
+            goals_data.append({
+                "id": g["id"],
+                "title": g["title"],
+                "deadline": g["deadline"],
+                "priority": g["priority"],
+                "days_left": days_left,
+                "progress": g["progress"],
+                "status": g["status"],
+                "tasks_done": done,
+                "total_tasks": len(g["tasks"]),
+            })
+            if days_left < min_days and g["status"] == "active":
+                min_days = days_left
+                most_urgent = g["title"]
+
+        # Weekly logs for chart
+        last_7 = (str(today - timedelta(days=i)) for i in range(6, -1, -1))
+        log_chart = [{"date": d, "hours": logs_by_date.get(d, 0)} for d in last_7]
+
+        return {
+            "name": mem["name"],
+            "mood": mem["mood"],
+            "streak": mem["streak"],
+            "week_hours": week_hours,
+            "total_hours": total_hours,
+            "goals": goals_data,
+            "most_urgent": most_urgent,
+            "log_chart": log_chart,
+            "active_count": sum(1 for g in mem["goals"] if g["status"] == "active"),
+            "completed_count": sum(1 for g in mem["goals"] if g["status"] == "completed"),
+        }
 
 
 # ---------------------------------------------------------------------------
 # Agent context helpers
 # ---------------------------------------------------------------------------
 
-def get_agent_context() -> dict:
+def get_agent_context(mem: dict | None = None) -> dict:
     """Return rich context for the LLM prompt."""
-    mem = load_memory()
-    goals_summary = []
-    for g in mem["goals"]:
-        recalc_goal(g)
-        _, days = calculate_priority(g)
-        pending = [t["task"] for t in g["tasks"] if t["status"] == "pending"]
-        goals_summary.append({
-            "title": g["title"],
-            "priority": g["priority"],
-            "days_left": days,
-            "progress": g["progress"],
-            "pending_tasks": pending,
-            "status": g["status"],
-        })
-    save_memory(mem)
-
-    recent_logs = mem["study_logs"][-7:]
-    return {
-        "name": mem["name"],
-        "mood": mem["mood"],
-        "streak": mem["streak"],
-        "goals": goals_summary,
-        "recent_logs": recent_logs,
-    }
+    with memory_session(mem) as mem:
+        goals_summary = []
+        for g, _, pending, days in _recalc_bulk(mem["goals"], date.today()):
+            goals_summary.append({
+                "title": g["title"],
+                "priority": g["priority"],
+                "days_left": days,
+                "progress": g["progress"],
+                "pending_tasks": pending,
+                "status": g["status"],
+            })
+
+        recent_logs = [
+            {"date": d, "hours": h} for d, h in sorted(mem["study_logs"].items())[-7:]
+        ]
+        return {
+            "name": mem["name"],
+            "mood": mem["mood"],
+            "streak": mem["streak"],
+            "goals": goals_summary,
+            "recent_logs": recent_logs,
+        }